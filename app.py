@@ -1,96 +1,353 @@
 import streamlit as st
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+import numpy as np
 import io
 import zipfile
 import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def add_text_to_image(image, text, height_from_base, font_size=40, font_color="white", 
-                      use_background=True, background_color="#000000", background_opacity=50, background_padding=10):
+# Optional faster codecs, the app falls back to Pillow when they are not installed
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbo_jpeg = TurboJPEG()
+except (ImportError, RuntimeError, OSError):
+    _turbo_jpeg = None
+
+try:
+    import deflate
+except ImportError:
+    deflate = None
+
+@st.cache_resource(show_spinner=False)
+def _get_font(font_size):
     """
-    Add text continuously horizontally across the image at a specified height from the base
+    Load the overlay font once per size and reuse it across images and reruns.
+    No spinner, as this is called from the processing thread pool without a script context.
     """
-    # Create a copy of the image to avoid modifying the original
-    img_copy = image.copy()
-    draw = ImageDraw.Draw(img_copy)
-    
     # Try to use a default font, fallback to basic font if not available
     try:
-        font = ImageFont.truetype("Arial.ttf", font_size)
+        return ImageFont.truetype("Arial.ttf", font_size)
     except:
         try:
-            font = ImageFont.truetype("/System/Library/Fonts/Arial.ttf", font_size)
+            return ImageFont.truetype("/System/Library/Fonts/Arial.ttf", font_size)
         except:
-            font = ImageFont.load_default()
+            return ImageFont.load_default()
+
+@st.cache_data(show_spinner=False)
+def _get_text_bbox(text, font_size):
+    """
+    Measure the text once per (text, font size) instead of once per image
+    """
+    draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+    return draw.textbbox((0, 0), text, font=_get_font(font_size))
+
+@st.cache_data(show_spinner=False)
+def _render_text_tile(text, font_size):
+    """
+    Lay out and rasterize the text a single time per (text, font size) into a grayscale
+    coverage tile spanning its full ink extent, which starts text_bbox[0] from the text origin.
+    The tile holds one copy of the text, independent of spacing, so it can be stamped at any
+    repetition's position without losing overhanging glyphs.
+    """
+    text_bbox = _get_text_bbox(text, font_size)
+    
+    # Glyphs such as 'j' can have ink left of the origin (negative text_bbox[0]), so draw
+    # the text shifted into the tile rather than clipping at the origin
+    tile = Image.new('L', (text_bbox[2] - text_bbox[0], text_bbox[3]), 0)
+    ImageDraw.Draw(tile).text((-text_bbox[0], 0), text, fill=255, font=_get_font(font_size))
+    return tile
+
+@st.cache_data(show_spinner=False)
+def _render_text_strip(text, font_size, width, spacing):
+    """
+    Render the coverage mask of the repeated text across a strip once per (text, font, width)
+    so every image of that width can reuse it, whatever the font color
+    """
+    text_bbox = _get_text_bbox(text, font_size)
+    total_text_width = text_bbox[2] - text_bbox[0] + spacing
+    strip = Image.new('L', (width, text_bbox[3]), 0)
+    
+    # The text is only rasterized once, even when the batch mixes image widths
+    tile = _render_text_tile(text, font_size)
+    if tile.width == 0:
+        return strip.tobytes()
+    
+    # Calculate how many times the text can fit across the image width
+    num_repetitions = (width + total_text_width - 1) // total_text_width
+    
+    # Stamp the tile at each repetition's own x instead of drawing the text again. Filling
+    # through the coverage mask blends overlapping ink the way draw.text does, so overhangs
+    # into the neighbouring spacing are kept and edges are clipped like the image bounds
+    for i in range(num_repetitions):
+        strip.paste(255, (i * total_text_width + text_bbox[0], 0), tile)
+    return strip.tobytes()
+
+def add_text_to_image(image, text, height_from_base, font_size=40, font_color="white", 
+                      use_background=True, background_color="#000000", background_opacity=50, background_padding=10,
+                      text_bbox=None):
+    """
+    Add text continuously horizontally across the image at a specified height from the base.
+    Everything is blended in RGB directly; an RGB image is modified in place and returned,
+    so callers pass an image they own.
+    text_bbox can be passed in when the text has already been measured for the batch.
+    """
+    # Keep a single RGB working mode throughout, with colors as RGB tuples unless already parsed
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if isinstance(font_color, str):
+        font_color = ImageColor.getrgb(font_color)
+    if isinstance(background_color, str):
+        background_color = ImageColor.getrgb(background_color)
     
     # Get image dimensions
-    img_width, img_height = img_copy.size
+    img_width, img_height = image.size
     
     # Calculate text dimensions
-    text_bbox = draw.textbbox((0, 0), text, font=font)
-    text_width = text_bbox[2] - text_bbox[0]
+    if text_bbox is None:
+        text_bbox = _get_text_bbox(text, font_size)
     text_height = text_bbox[3] - text_bbox[1]
     
+    # Nothing to draw when the image is shorter than the text, measured from its origin
+    # down to the bottom of its ink
+    if img_height < text_bbox[3]:
+        return image
+    
     # Add some spacing between repeated text
     spacing = 20
-    total_text_width = text_width + spacing
     
-    # Calculate Y position (height from base)
+    # Calculate Y position (height from base), then clamp the origin so every row of the
+    # text, from the origin to text_bbox[3], stays inside the image
     y = img_height - height_from_base - text_height
+    y = max(0, min(y, img_height - text_bbox[3]))
+    
+    # The text strip starts at the text origin, the background covers the text plus padding
+    strip_height = text_bbox[3]
+    strip_top, strip_bottom = y, y + strip_height
+    bg_top, bg_bottom = y - background_padding, y + text_height + background_padding + 1
+    
+    # Only the rows touched by the overlay are read, blended and written back
+    if use_background:
+        band_top = max(0, min(strip_top, bg_top))
+        band_bottom = min(img_height, max(strip_bottom, bg_bottom))
+    else:
+        band_top = max(0, strip_top)
+        band_bottom = min(img_height, strip_bottom)
+    
+    if band_top >= band_bottom:
+        return image
+    
+    band = np.array(image.crop((0, band_top, img_width, band_bottom)), dtype=np.float32)
     
     # Add background if enabled
     if use_background:
-        # Convert hex color to RGB
-        bg_color = tuple(int(background_color[i:i+2], 16) for i in (1, 3, 5))
+        bg_color = background_color[:3]
         # Calculate opacity (0-255 from 0-100%)
         opacity = int((background_opacity / 100) * 255)
         
-        # Create a semi-transparent overlay
-        overlay = Image.new('RGBA', img_copy.size, (0, 0, 0, 0))
-        overlay_draw = ImageDraw.Draw(overlay)
+        bg_rows_top, bg_rows_bottom = max(bg_top, band_top), min(bg_bottom, band_bottom)
+        if bg_rows_top < bg_rows_bottom:
+            alpha = opacity / 255.0
+            rows = slice(bg_rows_top - band_top, bg_rows_bottom - band_top)
+            band[rows] = band[rows] * (1 - alpha) + np.array(bg_color, dtype=np.float32) * alpha
+    
+    # Composite the pre-rendered text strip, shared by every image of the same width
+    text_rows_top, text_rows_bottom = max(strip_top, band_top), min(strip_bottom, band_bottom)
+    if text_rows_top < text_rows_bottom:
+        fg_color = np.array(font_color[:3], dtype=np.float32)
+        
+        strip = np.frombuffer(
+            _render_text_strip(text, font_size, img_width, spacing),
+            dtype=np.uint8
+        ).reshape(strip_height, img_width)
+        coverage = strip[text_rows_top - strip_top:text_rows_bottom - strip_top, :, np.newaxis]
+        text_alpha = coverage.astype(np.float32) / 255.0
+        rows = slice(text_rows_top - band_top, text_rows_bottom - band_top)
+        band[rows] = band[rows] * (1 - text_alpha) + fg_color * text_alpha
+    
+    # Round like alpha_composite and masked paste do, rather than truncating
+    image.paste(Image.fromarray(np.rint(band).astype(np.uint8)), (0, band_top))
+    
+    return image
+
+def _decode_jpeg_turbo(file_bytes, size, max_dimension, icc_profile=None):
+    """
+    Decode a JPEG with libjpeg-turbo, picking the same 1/2, 1/4 or 1/8 scale as Image.draft would
+    (full size when max_dimension is 0). The source ICC profile is kept on the decoded image.
+    """
+    width, height = size
+    scale = min(width // max_dimension, height // max_dimension) if max_dimension else 1
+    denominator = next((d for d in (8, 4, 2) if scale >= d), 1)
+    pixels = _turbo_jpeg.decode(file_bytes, pixel_format=TJPF_RGB, scaling_factor=(1, denominator))
+    decoded = Image.fromarray(pixels, 'RGB')
+    if icc_profile:
+        decoded.info['icc_profile'] = icc_profile
+    return decoded
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _process_cached(file_bytes, text_options, compress_level=1, max_dimension=0):
+    """
+    Open, convert, overlay and encode one image, memoized on its bytes and the overlay settings
+    so reruns only reprocess images whose inputs changed. Returns the full-resolution PNG bytes
+    and the JPEG bytes of a smaller preview.
+    """
+    # Open and process image
+    image = Image.open(io.BytesIO(file_bytes))
+    
+    # Let the JPEG decoder downscale by 1/2, 1/4 or 1/8 while keeping at least max_dimension pixels.
+    # This shrinks the downloaded image too, so it only happens when max_dimension is set.
+    if image.format == 'JPEG':
+        if _turbo_jpeg is not None and image.mode in ('RGB', 'L'):
+            image = _decode_jpeg_turbo(file_bytes, image.size, max_dimension, image.info.get('icc_profile'))
+        elif max_dimension:
+            image.draft('RGB', (max_dimension, max_dimension))
+    
+    # Convert to RGB if necessary (for PNG with transparency)
+    if image.mode == 'RGBA':
+        # Flatten onto white in a single NumPy pass instead of split() + masked paste
+        pixels = np.asarray(image, dtype=np.uint8)
+        alpha = pixels[..., 3:4].astype(np.float32) / 255.0
+        flattened = pixels[..., :3].astype(np.float32) * alpha + 255.0 * (1 - alpha)
+        image = Image.fromarray(np.rint(flattened).astype(np.uint8), 'RGB')
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    
+    # Add text to image
+    processed_image = add_text_to_image(image, **text_options)
+    data = _encode_png(processed_image, compress_level)
+    
+    # The full-resolution image is only needed for download, so shrink it in place for the preview
+    processed_image.thumbnail((800, 800), Image.Resampling.BILINEAR)
+    preview_buffer = io.BytesIO()
+    processed_image.save(preview_buffer, format='JPEG', quality=85)
+    
+    return data, preview_buffer.getvalue()
+
+def _process_one(uploaded_file, text_options, compress_level=1, max_dimension=0):
+    """
+    Process a single uploaded image so the batch can run in a thread pool
+    """
+    data, preview = _process_cached(uploaded_file.getvalue(), text_options, compress_level, max_dimension)
+    return uploaded_file.name, preview, data
+
+def _encode_png(img, compress_level=1):
+    """
+    Encode an image as PNG bytes so the same data can feed both the ZIP and the individual download
+    """
+    # libvips writes PNGs considerably faster than Pillow's zlib encoder
+    if pyvips is not None:
+        width, height = img.size
+        vips_img = pyvips.Image.new_from_memory(img.tobytes(), width, height, len(img.getbands()), 'uchar')
+        # Keep the color profile, as Pillow does when saving
+        icc_profile = img.info.get('icc_profile')
+        if icc_profile:
+            vips_img = vips_img.copy()
+            vips_img.set_type(pyvips.GValue.blob_type, 'icc-profile-data', icc_profile)
+        return vips_img.write_to_buffer('.png', compression=compress_level)
+    
+    img_buffer = io.BytesIO()
+    img.save(img_buffer, format='PNG', compress_level=compress_level, optimize=False)
+    return img_buffer.getvalue()
+
+def _processed_filename(filename):
+    """
+    Create a new filename with '_processed' suffix
+    """
+    name, ext = os.path.splitext(filename)
+    return f"{name}_processed.png"
+
+def _write_deflated_zip(encoded_images):
+    """
+    Write a zip file whose entries are compressed with libdeflate, emitting the raw
+    local headers, central directory and end record. Returns None when the archive would
+    need ZIP64 or does not read back as written, so the caller can fall back to zipfile.
+    """
+    zip_buffer = io.BytesIO()
+    central_directory = []
+    expected_entries = []
+    
+    # Sizes and offsets are 32-bit and the entry count 16-bit without ZIP64
+    zip_limit = 0xFFFFFFFF
+    if len(encoded_images) >= 0xFFFF:
+        return None
+    
+    # MS-DOS date and time fields used by zip headers
+    now = time.localtime()
+    dos_time = (now.tm_hour << 11) | (now.tm_min << 5) | (now.tm_sec // 2)
+    dos_date = ((now.tm_year - 1980) << 9) | (now.tm_mon << 5) | now.tm_mday
+    
+    for data, new_filename in encoded_images:
+        name = new_filename.encode('utf-8')
+        compressed = deflate.deflate_compress(data, 1)
+        crc = zlib.crc32(data)
+        offset = zip_buffer.tell()
+        if max(len(data), len(compressed), offset + len(compressed) + len(name) + 30) >= zip_limit:
+            return None
         
-        background_coords = [
-            0,
-            y - background_padding,
-            img_width,
-            y + text_height + background_padding
-        ]
-        overlay_draw.rectangle(background_coords, fill=(*bg_color, opacity))
+        # Version 2.0, UTF-8 filename flag, method 8 (deflate)
+        header_fields = (20, 0x0800, 8, dos_time, dos_date, crc, len(compressed), len(data), len(name), 0)
+        zip_buffer.write(struct.pack('<IHHHHHIIIHH', 0x04034b50, *header_fields))
+        zip_buffer.write(name)
+        zip_buffer.write(compressed)
         
-        # Composite the overlay onto the image
-        img_copy = Image.alpha_composite(img_copy.convert('RGBA'), overlay).convert('RGB')
-        draw = ImageDraw.Draw(img_copy)
+        central_directory.append(
+            struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, *header_fields, 0, 0, 0, 0, offset) + name
+        )
+        expected_entries.append((new_filename, crc, len(compressed), len(data), offset))
     
-    # Calculate how many times the text can fit across the image width
-    num_repetitions = (img_width // total_text_width) + 2  # +2 to ensure full coverage
+    directory_offset = zip_buffer.tell()
+    for record in central_directory:
+        zip_buffer.write(record)
+    directory_size = zip_buffer.tell() - directory_offset
+    if zip_buffer.tell() >= zip_limit:
+        return None
     
-    # Draw the text repeatedly across the width
-    for i in range(num_repetitions):
-        x = i * total_text_width
-        # Only draw if the text starts within the image bounds
-        if x < img_width:
-            draw.text((x, y), text, fill=font_color, font=font)
+    count = len(central_directory)
+    zip_buffer.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, directory_size, directory_offset, 0))
+    
+    # Round-trip check: the central directory must read back exactly as written.
+    # This only parses the headers, the compressed data is not inflated again.
+    try:
+        with zipfile.ZipFile(zip_buffer) as zip_file:
+            written_entries = [
+                (info.filename, info.CRC, info.compress_size, info.file_size, info.header_offset)
+                for info in zip_file.infolist()
+            ]
+    except zipfile.BadZipFile:
+        return None
+    if written_entries != expected_entries:
+        return None
     
-    return img_copy
+    return zip_buffer.getvalue()
 
-def create_zip_file(processed_images, original_filenames):
+def create_zip_file(encoded_images, compact=False):
     """
-    Create a zip file containing all processed images
+    Create a zip file containing all processed images from their already encoded PNG bytes
+    and return its contents
     """
+    # libdeflate compresses considerably faster than zlib at the same ratio
+    if compact and deflate is not None:
+        zip_data = _write_deflated_zip(encoded_images)
+        if zip_data is not None:
+            return zip_data
+    
     zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for i, (img, filename) in enumerate(zip(processed_images, original_filenames)):
-            img_buffer = io.BytesIO()
-            img.save(img_buffer, format='PNG')
-            img_buffer.seek(0)
-            
-            # Create a new filename with '_processed' suffix
-            name, ext = os.path.splitext(filename)
-            new_filename = f"{name}_processed.png"
-            
-            zip_file.writestr(new_filename, img_buffer.getvalue())
+    # PNG data is already deflated, so store it as-is unless a compact archive was requested.
+    # zipfile switches to ZIP64 on its own for archives past 4 GiB
+    compression = zipfile.ZIP_DEFLATED if compact else zipfile.ZIP_STORED
+    with zipfile.ZipFile(zip_buffer, 'w', compression, compresslevel=1) as zip_file:
+        for data, new_filename in encoded_images:
+            zip_file.writestr(new_filename, data)
     
-    zip_buffer.seek(0)
-    return zip_buffer
+    # Hand back the archive bytes once; getvalue() shares the buffer when nothing else references it
+    return zip_buffer.getvalue()
 
 def main():
     st.set_page_config(
@@ -122,6 +379,30 @@ def main():
     background_opacity = st.sidebar.slider("Background opacity (%)", min_value=0, max_value=100, value=50)
     background_padding = st.sidebar.slider("Background padding", min_value=0, max_value=30, value=10)
     
+    # Output configuration
+    st.sidebar.header("Output Configuration")
+    png_compress_level = st.sidebar.slider(
+        "PNG compression (1=fast, 9=small)",
+        min_value=1,
+        max_value=9,
+        value=1,
+        help="Higher levels produce smaller files but take longer to save"
+    )
+    max_dimension = st.sidebar.slider(
+        "Max dimension (JPEG decode, 0=full size)",
+        min_value=0,
+        max_value=8192,
+        value=0,
+        step=256,
+        help="When set, large JPEGs are decoded at 1/2, 1/4 or 1/8 scale as long as both sides stay at least "
+             "this size. This speeds up processing but the downloaded images are downscaled too"
+    )
+    compact_zip = st.sidebar.checkbox(
+        "Compact ZIP",
+        value=False,
+        help="Compress the PNGs again inside the ZIP. Usually saves little, as PNG data is already compressed"
+    )
+    
     # Initialize session state for file uploader
     if 'clear_files' not in st.session_state:
         st.session_state.clear_files = False
@@ -150,91 +431,88 @@ def main():
         
         # Process images
         if st.button("Process Images", type="primary"):
-            processed_images = []
-            original_filenames = []
+            text_options = {
+                "text": text_input,
+                "height_from_base": height_from_base,
+                "font_size": font_size,
+                # Parse the picked colors once for the whole batch
+                "font_color": ImageColor.getrgb(font_color),
+                "use_background": use_background,
+                "background_color": ImageColor.getrgb(background_color),
+                "background_opacity": background_opacity,
+                "background_padding": background_padding,
+                # Text and font size are the same for the whole batch, so measure once
+                "text_bbox": _get_text_bbox(text_input, font_size),
+            }
             
             # Create progress bar
             progress_bar = st.progress(0)
             status_text = st.empty()
+            status_text.text(f"Processing {len(uploaded_files)} image(s)...")
             
-            # Create columns for displaying images
-            cols = st.columns(min(3, len(uploaded_files)))
-            
-            for i, uploaded_file in enumerate(uploaded_files):
-                try:
-                    # Update progress
-                    progress = (i + 1) / len(uploaded_files)
-                    progress_bar.progress(progress)
-                    status_text.text(f"Processing {uploaded_file.name}...")
-                    
-                    # Open and process image
-                    image = Image.open(uploaded_file)
-                    
-                    # Convert to RGB if necessary (for PNG with transparency)
-                    if image.mode in ('RGBA', 'LA'):
-                        background = Image.new('RGB', image.size, (255, 255, 255))
-                        background.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
-                        image = background
-                    elif image.mode != 'RGB':
-                        image = image.convert('RGB')
-                    
-                    # Add text to image
-                    processed_image = add_text_to_image(
-                        image, 
-                        text_input, 
-                        height_from_base, 
-                        font_size, 
-                        font_color,
-                        use_background,
-                        background_color,
-                        background_opacity,
-                        background_padding
-                    )
+            # Process the images in parallel, keeping results in upload order
+            results = [None] * len(uploaded_files)
+            with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+                futures = {
+                    executor.submit(_process_one, uploaded_file, text_options, png_compress_level, max_dimension): i
+                    for i, uploaded_file in enumerate(uploaded_files)
+                }
+                for completed, future in enumerate(as_completed(futures), start=1):
+                    i = futures[future]
+                    try:
+                        results[i] = future.result()
+                    except Exception as e:
+                        results[i] = e
                     
-                    processed_images.append(processed_image)
-                    original_filenames.append(uploaded_file.name)
-                    
-                    # Display in columns
-                    col_idx = i % 3
-                    with cols[col_idx]:
-                        st.image(processed_image, caption=f"Processed: {uploaded_file.name}", use_container_width=True)
-                
-                except Exception as e:
-                    st.error(f"Error processing {uploaded_file.name}: {str(e)}")
+                    # Update progress
+                    progress_bar.progress(completed / len(uploaded_files))
+                    status_text.text(f"Processed {uploaded_files[i].name}")
             
             # Clear progress indicators
             progress_bar.empty()
             status_text.empty()
             
-            if processed_images:
-                st.success(f"Successfully processed {len(processed_images)} image(s)!")
+            # Create columns for displaying images
+            cols = st.columns(min(3, len(uploaded_files)))
+            
+            # Encoded once per image and reused for the ZIP and the individual downloads
+            encoded_images = []
+            
+            for i, (uploaded_file, result) in enumerate(zip(uploaded_files, results)):
+                if isinstance(result, Exception):
+                    st.error(f"Error processing {uploaded_file.name}: {str(result)}")
+                    continue
+                
+                filename, preview, data = result
+                encoded_images.append((data, _processed_filename(filename)))
+                
+                # Display the downscaled preview in columns
+                col_idx = i % 3
+                with cols[col_idx]:
+                    st.image(preview, caption=f"Processed: {filename}", use_container_width=True)
+            
+            if encoded_images:
+                st.success(f"Successfully processed {len(encoded_images)} image(s)!")
                 
                 # Create download button for zip file
-                zip_buffer = create_zip_file(processed_images, original_filenames)
+                zip_data = create_zip_file(encoded_images, compact_zip)
                 st.download_button(
                     label="📥 Download All Processed Images (ZIP)",
-                    data=zip_buffer.getvalue(),
+                    data=zip_data,
                     file_name="processed_images.zip",
                     mime="application/zip"
                 )
                 
                 # Individual download buttons
                 st.subheader("Individual Downloads")
-                download_cols = st.columns(min(3, len(processed_images)))
+                download_cols = st.columns(min(3, len(encoded_images)))
                 
-                for i, (img, filename) in enumerate(zip(processed_images, original_filenames)):
+                for i, (data, new_filename) in enumerate(encoded_images):
                     col_idx = i % 3
                     with download_cols[col_idx]:
-                        img_buffer = io.BytesIO()
-                        img.save(img_buffer, format='PNG')
-                        img_buffer.seek(0)
-                        
-                        name, ext = os.path.splitext(filename)
-                        new_filename = f"{name}_processed.png"
-                        
                         st.download_button(
                             label=f"📥 {new_filename}",
-                            data=img_buffer.getvalue(),
+                            data=data,
                             file_name=new_filename,
                             mime="image/png",
                             key=f"download_{i}"
@@ -0,0 +1,74 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import streamlit as st
+from PIL import Image, ImageDraw, ImageFont
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+
+FONT_SIZE = 80
+
+
+@pytest.fixture
+def font(monkeypatch):
+    """
+    A TrueType font at a fixed size, whatever fonts are installed on the machine
+    """
+    font = ImageFont.load_default(FONT_SIZE)
+    if not isinstance(font, ImageFont.FreeTypeFont):
+        pytest.skip("Pillow was built without FreeType")
+    monkeypatch.setattr(app, "_get_font", lambda font_size: font)
+    st.cache_data.clear()
+    yield font
+    st.cache_data.clear()
+
+
+def _reference_overlay(image, text, height_from_base, font, font_color):
+    """
+    Draw the text once per repetition, as the app did before the strip was cached
+    """
+    img_copy = image.copy()
+    draw = ImageDraw.Draw(img_copy)
+    text_bbox = draw.textbbox((0, 0), text, font=font)
+    total_text_width = text_bbox[2] - text_bbox[0] + 20
+    y = img_copy.height - height_from_base - (text_bbox[3] - text_bbox[1])
+    for i in range((img_copy.width // total_text_width) + 2):
+        x = i * total_text_width
+        if x < img_copy.width:
+            draw.text((x, y), text, fill=font_color, font=font)
+    return img_copy
+
+
+@pytest.mark.parametrize("text", ["j", "jump", "ÅÉÎ Ů", "Sample Text"])
+def test_repeated_text_matches_per_repetition_drawing(font, text):
+    image = Image.new("RGB", (600, 300), (0, 0, 0))
+    
+    expected = _reference_overlay(image, text, 100, font, "#FFFFFF")
+    result = app.add_text_to_image(image.copy(), text, 100, FONT_SIZE, "#FFFFFF", use_background=False)
+    
+    assert np.array_equal(np.asarray(result), np.asarray(expected))
+
+
+def test_font_has_ink_left_of_the_origin(font):
+    # The "j" cases above only cover the wrap-around if the glyph hangs left of its origin
+    assert font.getbbox("j")[0] < 0
+
+
+def test_text_is_not_cut_off_at_the_bottom_of_a_short_image(font):
+    # Exactly as tall as the text from its origin to the bottom of its ink, so placing the
+    # ink 10px above the base would push the bottom rows out of the image
+    text_bbox = font.getbbox("Sample Text")
+    assert text_bbox[1] > 10
+    
+    short = app.add_text_to_image(
+        Image.new("RGB", (600, text_bbox[3])), "Sample Text", 10, FONT_SIZE, "#FFFFFF", use_background=False
+    )
+    tall = app.add_text_to_image(
+        Image.new("RGB", (600, 400)), "Sample Text", 100, FONT_SIZE, "#FFFFFF", use_background=False
+    )
+    
+    assert np.asarray(short).any(axis=-1).sum() == np.asarray(tall).any(axis=-1).sum()